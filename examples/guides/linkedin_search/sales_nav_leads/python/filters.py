@@ -9,11 +9,13 @@ Data is saved as a JSONL file in the data folder.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 import time
 import json
 import faulthandler
 import urllib.parse
+from urllib3.util.retry import Retry
 
 
 faulthandler.enable(),
@@ -24,30 +26,68 @@ parser.add_argument("--api-key", help="The API key for the Lix API", dest="api_k
 parser.add_argument(
     "--result-path", help="The path to the JSONL results file", default="data/searchLeadsFacets.jsonl"
 )
+parser.add_argument("--verbose", help="Print how long each request takes", action="store_true")
 
 args = parser.parse_args()
 API_KEY = args.api_key
 RESULT_PATH = args.result_path
+VERBOSE = args.verbose
 
 search_url_base = "https://api.lix-it.com/v1/li/sales/search/people"
 facet_url_base = "https://api.lix-it.com/v1/search/sales/facet"
 
-sleep_time = 3  # sleep for 3 seconds to avoid rate limit
+sleep_time = 3  # wait 3 seconds between requests to avoid rate limit
+last_request_at = 0.0  # when the last rate limited request was started
+
+# Share one session so every request reuses the same pooled connection to the API.
+# Rate limited and server error responses are retried with exponential backoff, honouring Retry-After.
+SESSION = requests.Session()
+retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    respect_retry_after_header=True,
+)
+# requests are made one at a time, so a small pool is plenty
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry))
+SESSION.headers["Authorization"] = API_KEY
 
 # The job titles and companies we want to search for
 job_facets = ["Software engineer"]
 company_facets = ["Google"]
 
 
+# time a function call with a high-resolution clock, only when --verbose is set so
+# quiet runs don't pay for a print on every call
 def timeit(func):
+    if not VERBOSE:
+        return func
+
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter()
         result = func(*args, **kwargs)
-        print("Time taken: " + str(time.time() - start_time))
+        print("Time taken: " + str(time.perf_counter() - start_time))
         return result
 
     return wrapper
 
+def rate_limited(func):
+    """
+    Start requests at most once every sleep_time seconds. The time spent waiting on the API counts
+    towards the interval, so a slow response doesn't add a full sleep on top.
+    """
+    def wrapper(*args, **kwargs):
+        global last_request_at
+        wait = last_request_at + sleep_time - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        last_request_at = time.monotonic()
+        return func(*args, **kwargs)
+
+    return wrapper
+
 def build_search_url(filters):
     """
     Build the search URL from the filters
@@ -84,39 +124,40 @@ def build_query_filters(job_title_pairs, company_pairs):
 
     return f"List({','.join(filters)})"
 
+@rate_limited
 def get_job_title_facet(facet_query):
     """
     Get the ID of the job title
     """
     facet_url = facet_url_base + f"?type=TITLE&query={urllib.parse.quote(facet_query, safe="")}"
-    r = requests.get(facet_url, headers={"Authorization": API_KEY})
-    j = r.json()
+    r = SESSION.get(facet_url)
     if r.status_code != 200:
         print("Error getting job title facet")
         print(r.text)
         return (0, "")
-    time.sleep(sleep_time)
+    j = r.json()
     result = j["data"]["elements"][0]
     print(f"job title: {result["displayValue"]} id: {result["id"]}")
     return (result["id"], result["displayValue"])
 
+@rate_limited
 def get_company_facet(facet_query):
     """
     Get the ID of the company
     """
     facet_url = facet_url_base + f"?type=COMPANY_WITH_LIST&query={urllib.parse.quote(facet_query, safe="")}"
-    r = requests.get(facet_url, headers={"Authorization": API_KEY})
+    r = SESSION.get(facet_url)
     if r.status_code != 200:
         print("Error getting company facet")
         print(r.text)
         return (0, "")
     j = r.json()
-    time.sleep(sleep_time)
     result = j["data"]["elements"][0]["children"][0]
     print(f"company: {result["displayValue"]} id: {result["id"]}")
     return (result["id"], result["displayValue"])
 
 
+@rate_limited
 @timeit
 def get_page(url):
     print("getting", url)
@@ -124,32 +165,30 @@ def get_page(url):
     lix_profile_url = (
         search_url_base + "?url=" + urllib.parse.quote(url, safe="")
     )
-    # If data is missing then ignore errors and continue to next connection
-    success = False
-    while success == False:
-        try:
-            r = requests.get(lix_profile_url, headers={"Authorization": API_KEY})
-        except Exception as e:
-            print("Error getting profile data for " + url)
-            print(e)
-            time.sleep(sleep_time)
-            return 0
-        # check status
-        if r.status_code != 200:
-            print("Error getting page: " + str(r.status_code))
-            print(r.text)
-            break
-        success = True
-        print("got", url)
-        print(
-            f"first result: Name - {r.json()['people'][0]['name']}; Title - {r.json()['people'][0]['experience'][0]['title']}; Company - {r.json()['people'][0]['experience'][0]['organisation']['name']}; Link: {r.json()['people'][0]['salesNavLink']}"
-        )
-        with open(RESULT_PATH, "w") as f:
-            f.write(json.dumps(r.json()) + "\n")
-
-    if success:
-        print(f"saved to {RESULT_PATH}")
-        time.sleep(sleep_time)
+    # If data is missing then ignore errors and continue.
+    # Rate limits and internal errors have already been retried by the session.
+    try:
+        r = SESSION.get(lix_profile_url)
+    except Exception as e:
+        print("Error getting profile data for " + url)
+        print(e)
+        return 0
+    # check status
+    if r.status_code != 200:
+        print("Error getting page: " + str(r.status_code))
+        print(r.text)
+        return 0
+    print("got", url)
+    data = r.json()
+    person = data['people'][0]
+    experience = person['experience'][0]
+    print(
+        f"first result: Name - {person['name']}; Title - {experience['title']}; Company - {experience['organisation']['name']}; Link: {person['salesNavLink']}"
+    )
+    with open(RESULT_PATH, "w") as f:
+        f.write(json.dumps(data) + "\n")
+
+    print(f"saved to {RESULT_PATH}")
     return 1
 
 
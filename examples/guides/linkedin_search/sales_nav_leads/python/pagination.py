@@ -4,13 +4,20 @@ This script demonstrates how to use the Lix API to paginate through the results
 It starts by making a POST request to the Lix API to get the first page of search results. It then extracts the sequence ID and the total number of results from the response. 
 It continues to make subsequent requests to get the next pages of results until it has retrieved all the results.
 
-Data is saved as a JSONL file in the data folder.
+Data is saved as a JSONL file in the data folder. Progress is recorded in a .state.json file next to it, so an
+interrupted search carries on from the last saved page when the script is run again. If there is no state file,
+the search carries on from the last page in the results file instead.
 """
 
 import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
 import requests
+import sys
+from requests.adapters import HTTPAdapter
 import time
+from urllib3.util.retry import Retry
 
 
 parser = argparse.ArgumentParser()
@@ -23,83 +30,222 @@ parser.add_argument(
 args = parser.parse_args()
 API_KEY = args.api_key
 RESULT_PATH = args.result_path
-SLEEP_TIME = 3 # number of seconds to sleep between requests to avoid rate limit
+# Where the next page and sequence ID are recorded so an interrupted search can be resumed
+STATE_PATH = os.path.splitext(RESULT_PATH)[0] + ".state.json"
+SLEEP_TIME = 3 # minimum number of seconds between requests to avoid rate limit
+PER_PAGE = 25 # number of results the API returns per page
+last_request_at = 0.0 # when the last rate limited request was started
+
+# Share one session so every request reuses the same pooled connection to the API.
+# Rate limited and server error responses are retried with exponential backoff, honouring Retry-After.
+# The search is a read-only POST, so it is safe to retry.
+SESSION = requests.Session()
+retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "POST"],
+    respect_retry_after_header=True,
+)
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+SESSION.headers["Authorization"] = API_KEY
 
 base_search_url = "https://www.linkedin.com/sales/search/people#_ntb=17cxdwWvR5uFdc3u0WPY7g%3D%3D&query=(recentSearchParam%3A(id%3A2400172257%2CdoLogHistory%3Atrue)%2Cfilters%3AList((type%3ACURRENT_COMPANY%2Cvalues%3AList((id%3Aurn%253Ali%253Aorganization%253A1337%2Ctext%3ALinkedIn%2CselectionType%3AINCLUDED)))%2C(type%3ASENIORITY_LEVEL%2Cvalues%3AList((id%3A220%2Ctext%3ADirector%2CselectionType%3AINCLUDED)%2C(id%3A300%2Ctext%3AVice%2520President%2CselectionType%3AINCLUDED)%2C(id%3A310%2Ctext%3ACXO%2CselectionType%3AINCLUDED)))%2C(type%3ACURRENT_TITLE%2Cvalues%3AList((text%3A%2522Product%2520Management%2522%2520OR%2520%2522VP%2520Product%2520Management%2522%2520OR%2520%2522Vice%2520President%2520of%2520Product%2520management%2522%2520OR%2520%2522Director%2520of%2520Product%2520Management%2520%2522%2520OR%2520%2522Head%2520of%2520Product%2520Management%2522%2520OR%2520%2522VP%252C%2520Product%2520Management%2522%2520OR%2520%2522VP%2520of%2520Product%2520Management%2522%2520OR%2520%2522Vice%2520President%252C%2520Product%2520management%2522%2520OR%2520%2522Product%2520Marketing%2522%2520OR%2520%2522VP%2520of%2520Product%2520Marketing%2522%2520OR%2520%2522Vice%2520President%2520Product%2520Marketing%2522%2520OR%2520%2522Vice%2520President%2520of%2520Product%2520Marketing%2522%2520OR%2520%2522Director%2520of%2520Product%2520Marketing%2520%2522%2520OR%2520%2522Head%2520of%2520Product%2520Marketing%2522%2520OR%2520%2522VP%2520Solution%2520Marketing%2522%2520OR%2520%2522Demand%2520Generation%2522%2520OR%2520%2522Vice%2520President%2520of%2520demand%2520Generation%2522%2520OR%2520%2522Head%2520of%2520Demand%2520generation%2522%2520OR%2520%2522Director%2520of%2520Demand%2520generation%2522%2520OR%2520%2522Product%2522%2520OR%2520%2522VP%2520Product%2522%2520OR%2520%2522VP%2520of%2520Product%2522%2520OR%2520%2522Vice%2520president%2520of%2520Product%2522%2520OR%2520%2522head%2520of%2520Product%2522%2520OR%2520%2522Director%2520of%2520product%2522%2520OR%2520%2522Customer%2520Marketing%2522%2520OR%2520%2522Vp%2520of%2520Customer%2520Marketing%2522%2520OR%2520%2522Vice%2520president%2520of%2520Customer%2520Marketing%2522%2520OR%2520%2522Head%2520of%2520Customer%2520Marketing%2522%2520OR%2520%2522Director%2520of%2520Customer%2520Marketing%2522%2520OR%2520%2522Director%2520Analyst%2520Relations%2522%2520OR%2520%2522Director%2520of%2520Analyst%2520Relations%2522%2520OR%2520%2522Head%2520of%2520Analyst%2520Relations%2522%2520OR%2520%2522Chief%2520Executive%2520Officer%2522%2520OR%2520%2522CEO%2522%2520OR%2520%2522Chief%2520Executive%2522%2520OR%2520%2522CMO%2522%2520OR%2520%2522Chief%2520Marketing%2520Officer%2522%2520OR%2520%2522Chief%2520Product%2520Officer%2522%2520OR%2520%2522SVP%2520Product%2522%2520OR%2520%2522VP%2520Service%2520Offerings%2522%2520OR%2520%2522VP%2520Product%2520Officer%2522%2520OR%2520%2522Service%2520Management%2522%2520OR%2520%2522Advanced%2520Technology%2522%2520OR%2520%2522Service%2520Line%2520Manager%2522%2520OR%2520%2522Integrated%2520Marketing%2522%2520OR%2520%2522General%2520Manager%2522%2520OR%2520%2522Chief%2520Technology%2520Officer%2522%2520OR%2520%2522CTO%2522%2520OR%2520%2522Product%2520Manager%2522%2520OR%2520%2522Senior%2520Product%2520Manager%2522%2520OR%2520%2522Director%2520Product%2520management%2522%2520OR%2520%2522VP%2520of%2520solution%2520Marketing%2522%2520OR%2520%2522Solution%2520Marketing%2522%2520OR%2520%2522VP%2520of%2520Demand%2520generation%2522%2520OR%2520%2522regional%2520head%2520of%2520marketing%2522%2520OR%2520%2522BU%2520head%2520of%2520marketing%2522%2520OR%2520%2522Head%2520of%2520marketing%2522%2520OR%2520%2522Chief%2520Strategy%2520Officer%2522%2520OR%2520%2522CSO%2522%2520OR%2520%2522Delivery%2520leader%2522%2520OR%2520%2522Board%2520of%2520Directors%2522%2520OR%2520%2522VP%2520of%2520marketing%2522%2520OR%2520%2522VP%2520of%2520sales%2522%2520OR%2520%2522Product%2520Development%2522%2520OR%2520%2522VP%2520Product%2520Development%2522%2520OR%2520%2522Director%2520product%2520Development%2522%2520OR%2520%2522Director%2520Product%2520marketing%2522%2520OR%2520%2522Demand%2520Gen%2522%2520OR%2520%2522CPO%2522%2520OR%2520%2522Product%2520Development%2522%2520OR%2520%2522VP%2520Product%2520Development%2522%2520OR%2520%2522Vice%2520President%2520of%2520Product%2520Development%2522%2520OR%2520%2522Director%2520of%2520Product%2520Development%2520%2522%2520OR%2520%2522Head%2520of%2520Product%2520Development%2522%2520OR%2520%2522VP%252C%2520Product%2520Development%2522%2520OR%2520%2522VP%2520of%2520Product%2520Development%2522%2520OR%2520%2522Vice%2520President%252C%2520Product%2520Development%2522%2520OR%2520%2522Business%2520Unit%2520Head%2520of%2520Marketing%2522%2520OR%2520%2522Vice%2520President%2520Customer%2520Marketing%2522%2520OR%2520%2522Analyst%2520Relations%2522%2520OR%2520%2522Sr%2520Director%2520of%2520Analyst%2520Relations%2522%2520OR%2520%2522Chief%2520Marketing%2522%2520OR%2520%2522C.E.O.%2522%2520OR%2520%2522Chief%2520Product%2522%2520OR%2520%2522c.e.o.%2522%2CselectionType%3AINCLUDED)))%2C(type%3AREGION%2Cvalues%3AList((id%3A103644278%2Ctext%3AUnited%2520States%2CselectionType%3AINCLUDED)))))&sessionId=Bj7j4q%2FzTEOY9SsYR03v9Q%3D%3D"
 
+def rate_limited(func):
+    """
+    Start requests at most once every SLEEP_TIME seconds. The time spent waiting on the API counts
+    towards the interval, so a slow response doesn't add a full sleep on top.
+    """
+    def wrapper(*args, **kwargs):
+        global last_request_at
+        wait = last_request_at + SLEEP_TIME - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        last_request_at = time.monotonic()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+@rate_limited
 def get_page(url, page, sequence_id):
     print("Getting page", page)
     
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Authorization': API_KEY, 
-    }
     payload = {
         # NOTE: you do not need to URL encode the url if you are using the POST version of the endpoint.
         "url": url + f"&page={page}",
         "sequence_id": sequence_id,
     }
-    success = False
-    while success == False:
-        # Using the POST version of this endpoint allows you to use very large queries that would not fit in a URL
-        response = requests.request(
-            "POST",
-            "http://api.lix-it.com/v1/li/sales/search/people",
-            headers=headers,
-            data=payload,
-        )
-
-        if response.status_code != 200:
-            print("Error getting page: " + str(response.status_code))   
-            time.sleep(SLEEP_TIME)
-            continue
-
-        time.sleep(SLEEP_TIME)
+    # Using the POST version of this endpoint allows you to use very large queries that would not fit in a URL
+    response = SESSION.post(
+        "https://api.lix-it.com/v1/li/sales/search/people",
+        data=payload,
+    )
+
+    # Rate limits and internal errors have already been retried by the session, so stop here and
+    # resume the search later
+    if response.status_code != 200:
+        print("Error getting page: " + str(response.status_code))
+        print(response.text)
+        raise Exception("Error getting page " + str(response.status_code))
+
+    return response.json()
+
+def read_last_result(path):
+    """
+    Read the last complete page saved to the results file, reading backwards from the end of the file so
+    that long runs don't need to load the whole file. Also returns the size of the file up to the end of
+    that page, so a partial line left by an interrupted run can be cut off before appending.
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        tail = b""
+        while True:
+            # ignore anything after the last newline, it is a page that was only partly written
+            complete = tail[: tail.rfind(b"\n") + 1]
+            # keep reading blocks until the tail holds the whole of the last complete line
+            if end == 0 or b"\n" in complete.rstrip(b"\n"):
+                break
+            start = max(0, end - 65536)
+            f.seek(start)
+            tail = f.read(end - start) + tail
+            end = start
+    lines = complete.splitlines()
+    if not lines:
+        return None, end + len(complete)
+    return json.loads(lines[-1]), end + len(complete)
+
+def load_state():
+    """
+    Load where to carry on from, as recorded by save_state. Results files written without a state file,
+    e.g. by older versions of this script, carry on from their last saved page instead.
+    """
+    try:
+        with open(STATE_PATH, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = None
+
+    # a state that points past the end of the results file, e.g. one left behind after the results file
+    # was deleted, no longer describes it, so work from the results file instead
+    result_size = os.path.getsize(RESULT_PATH) if os.path.exists(RESULT_PATH) else 0
+    if state is not None and (state.get("offset") or 0) > result_size:
+        print("Ignoring", STATE_PATH, "as it does not match", RESULT_PATH)
+        state = None
+
+    if state is not None:
+        return {
+            "next_page": state["next_page"],
+            "sequence_id": state["sequence_id"],
+            "count": state["count"],
+            "offset": state.get("offset"),
+            "finished": state.get("finished", False),
+        }
 
-        return response.json()
+    try:
+        last_result, offset = read_last_result(RESULT_PATH)
+    except FileNotFoundError:
+        last_result, offset = None, None
+    if not last_result or not last_result['people']:
+        return {"next_page": 1, "sequence_id": "", "count": 0, "offset": offset, "finished": False}
+    page = last_result['people'][0]['page']
+    count = page * PER_PAGE
+    return {
+        "next_page": page + 1,
+        "sequence_id": last_result['meta']['sequenceId'],
+        "count": count,
+        "offset": offset,
+        "finished": count + PER_PAGE >= last_result['paging']['total'],
+    }
 
-    return 1
+def save_state(next_page, sequence_id, count, offset, finished):
+    """
+    Record where to carry on from, how much of the results file those pages take up and whether the
+    search is complete. The state is written to a temporary file and renamed over the old one so an
+    interrupted write can never leave it half written.
+    """
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {"next_page": next_page, "sequence_id": sequence_id, "count": count, "offset": offset, "finished": finished},
+            f,
+        )
+    os.replace(tmp_path, STATE_PATH)
 
-def collect_search(start_page = 1):
+def collect_search(result_file, start_page = 1, sequence_id = "", count = 0):
     finish = False
     page = start_page
 
-    sequence_id = ""
-    count = 0
-    per_page = 25
-    while not finish:
-        print("page:", page, "sequence_id:", sequence_id, "count:", count)
-
-        result = get_page(base_search_url, page, sequence_id)
+    # where to carry on from, matching the pages that have been written to the results file
+    resume_page = start_page
+    resume_sequence_id = sequence_id
+    resume_count = count
+    resume_offset = result_file.tell()
+    resume_finished = False
+    # A single background worker fetches the next page while the current one is being saved
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        next_result = executor.submit(get_page, base_search_url, page, sequence_id)
+        while not finish:
+            print("page:", page, "sequence_id:", sequence_id, "count:", count)
 
-        count += result['paging']['count']
+            result = next_result.result()
 
-        # add the page to the results
-        for i in range(len(result['people'])):
-            result['people'][i]['page'] = page
+            count += result['paging']['count']
 
-        with open(RESULT_PATH, 'a') as f:
-            f.write(json.dumps(result) + '\n')
+            # record this page's sequence ID even on the last page, so the saved state is up to date
+            sequence_id = result['meta']['sequenceId']
 
-        print("total:", result['paging']['total'], "count:", count, "finish:", finish)
+            # 25 per page, if there is a remainder then only go one page further
+            if count + PER_PAGE >= result['paging']['total']:
+                finish = True
+            else:
+                # the next page only needs this page's sequence ID, so start fetching it straight away
+                next_result = executor.submit(get_page, base_search_url, page + 1, sequence_id)
+
+            # add the page to the results
+            for i in range(len(result['people'])):
+                result['people'][i]['page'] = page
+
+            # requests are seconds apart, so flush and checkpoint every page; a crash then loses
+            # at most the page being written
+            result_file.write(json.dumps(result) + '\n')
+            result_file.flush()
+            resume_page = page + 1
+            resume_sequence_id = sequence_id
+            resume_count = count
+            resume_offset = result_file.tell()
+            resume_finished = finish
+            save_state(resume_page, resume_sequence_id, resume_count, resume_offset, resume_finished)
+
+            print("total:", result['paging']['total'], "count:", count, "finish:", finish)
 
-        # 25 per page, if there is a remainder then only go one page further
-        if count + per_page >= result['paging']['total']:
-            finish = True
-        else:
-            sequence_id = result['meta']['sequenceId']
             page = page + 1
-
+    finally:
+        executor.shutdown(cancel_futures=True)
+        # checkpoint whatever was written before stopping, even if the search failed part way
+        result_file.flush()
+        save_state(resume_page, resume_sequence_id, resume_count, resume_offset, resume_finished)
 
 
 if __name__ == "__main__":
-    # Open up the result file to see how many pages we've retrieved so far
-    start_page = 1
+    # Check the saved state to see where to carry on from
+    state = load_state()
+    if state["finished"]:
+        print("The search has already been collected to", RESULT_PATH)
+        sys.exit(0)
+
+    # Keep the results file open for the whole run rather than reopening it for every page
+    result_file = open(RESULT_PATH, 'a', buffering=1024 * 1024)
     try:
-        with open(RESULT_PATH, "r") as f:
-            results = f.readlines()
-            start_page = len(results) + 1
-    except FileNotFoundError:
-        open(RESULT_PATH, 'a').close()
-
-    collect_search(start_page)
+        # drop anything written after the last checkpoint, such as half a line from a killed run,
+        # so the pages appended from here on line up with the saved state
+        if state["offset"] is not None:
+            result_file.truncate(state["offset"])
+            # truncating doesn't move the file position, so move it back to the new end before
+            # collect_search records it
+            result_file.seek(0, os.SEEK_END)
+        collect_search(result_file, state["next_page"], state["sequence_id"], state["count"])
+    finally:
+        result_file.close()
@@ -10,15 +10,24 @@ Usage: python org.py migrate # to set up the database
 """
 
 import argparse
-import datetime
-import json
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
 import requests
+from requests.adapters import HTTPAdapter
 import sqlite3
 import sys
 import time
+import urllib.parse
+from urllib3.util.retry import Retry
 
 # Arguments
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--api-key", help="The API key for the Lix API", dest="api_key")
 parser.add_argument(
@@ -29,6 +38,15 @@ parser.add_argument(
     help="The path to the CSV file to import",
     default="input/orgs.csv",
 )
+parser.add_argument(
+    "--workers",
+    help="The number of org profiles to fetch concurrently",
+    type=positive_int,
+    default=5,
+)
+parser.add_argument(
+    "--verbose", help="Print how long each request takes", action="store_true"
+)
 parser.add_argument(
     "command", help="The command to run", choices=["migrate", "run", "import"]
 )
@@ -36,21 +54,64 @@ args = parser.parse_args()
 
 API_KEY = args.api_key
 db_path = args.db_path
+workers = args.workers
+verbose = args.verbose
 
 # Parameters
-sleep_time = 0.1  # sleep for 1 second to avoid rate limit
+batch_size = 100  # number of org profiles to fetch and save per database transaction
+
+# Statements used to save collected profiles, kept constant so sqlite3 reuses the prepared statements
+INSERT_SQL = "insert into orgs_enriched (org_id, data, collected_at) values (?, ?, ?)"
+UPDATE_SQL = "update orgs set last_collected_at = ? where id = ?"
+
+# Share one session so every request reuses the same pooled connection to the API.
+# Rate limited and server error responses are retried with exponential backoff, honouring Retry-After.
+SESSION = requests.Session()
+retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+)
+# keep a pooled connection for every worker thread, so none of them has to open its own
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=workers, max_retries=retry))
+SESSION.headers["Authorization"] = API_KEY
 
 # helper functions
+# write a message as a single line in one call; print() writes the newline separately, so lines printed
+# from different threads while collecting can run together
+def log(message):
+    sys.stdout.write(message + "\n")
+
+
+# time a function call with a high-resolution clock, only when --verbose is set so
+# quiet runs don't pay for a print on every call
 def timeit(func):
+    if not verbose:
+        return func
+
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter()
         result = func(*args, **kwargs)
-        print("Time taken: " + str(time.time() - start_time))
+        log("Time taken: " + str(time.perf_counter() - start_time))
         return result
 
     return wrapper
 
 
+# open the database, using the write-ahead log so commits are cheap appends
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # with WAL, NORMAL only risks losing the last commits on power loss, not corrupting the database
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
 # set up migrations for database
 def migrate(conn):
     # The orgs table stores a list of profile links
@@ -58,21 +119,28 @@ def migrate(conn):
         id integer primary key autoincrement,
         name text,
         link text,
-        last_collected_at datetime
+        last_collected_at integer
     )"""
     conn.execute(org_stmt)
 
     # This table stores a list of profile data
+    # Timestamps are stored as unix epoch seconds, use datetime.fromtimestamp() to read them
     orgs_enriched_stmt = """create table if not exists orgs_enriched (
         id integer primary key autoincrement,
         org_id integer,
         data text,
-        collected_at datetime,
+        collected_at integer,
 
         foreign key(org_id) references orgs(id)
     )"""
     conn.execute(orgs_enriched_stmt)
 
+    # This partial index only holds the profile links that still need collecting, so finding
+    # pending work doesn't scan the whole table
+    orgs_pending_stmt = """create index if not exists orgs_pending_idx on orgs(last_collected_at)
+        where last_collected_at is null"""
+    conn.execute(orgs_pending_stmt)
+
 
 # get all profile links that have not been collected yet
 def get_people(conn):
@@ -82,88 +150,118 @@ def get_people(conn):
     return orgs
 
 
+# work out what to do with a response once the session has finished retrying it:
+# "ok", "not_found" (skip the profile) or "fail" (stop collecting)
+def classify_response(r):
+    if r.status_code == 200:
+        return "ok"
+    if r.status_code == 404:
+        return "not_found"
+    # missing profiles can also be reported as a bad request with a not_found error; any other
+    # bad request, including one without a JSON error body, is a failure
+    if r.status_code == 400:
+        try:
+            if r.json()["error"]["type"] == "not_found":
+                return "not_found"
+        except (ValueError, KeyError, TypeError):
+            pass
+    return "fail"
+
+
+# get_profile runs on worker threads, so each message is a single log line naming the url; the main thread
+# reports each profile it collects
 @timeit
 def get_profile(url):
-    print("getting", url)
-    # encode the url
-    lix_url = (
-        "https://api.lix-it.com/v1/organisations/by-linkedin" + "?linkedin_url=" + url
+    # encode the url once, the session reuses the same request for any retries
+    lix_url = "https://api.lix-it.com/v1/organisations/by-linkedin?" + urllib.parse.urlencode(
+        {"linkedin_url": url}
     )
 
-    # If data is missing then ignore errors and continue to next connection
-    success = False
-    while success == False:
-        try:
-            r = requests.get(lix_url, headers={"Authorization": API_KEY})
-        except Exception as e:
-            print("Error getting profile data for " + url)
-            print(e)
-            time.sleep(sleep_time)
-            return 0
-        # check status
-        if r.status_code != 200:
-            if r.status_code == 404:
-                print("Profile not found: " + url)
-                break
-            if r.status_code == 400:
-                # process the json body
-                j = r.json()
-                if j["error"]["type"] == "not_found":
-                    print("Profile not found: " + url)
-                    break
-            if r.status_code == 429:
-                print("Rate limit exceeded")
-                time.sleep(sleep_time)
-                continue
-            # if a client error then stop
-            if r.status_code > 399 and r.status_code < 500:
-                print("Error getting profile: " + str(r.status_code))
-                print(r.text)
-                raise Exception("Client error " + str(r.status_code))
-            # If an internal error then retry
-            if r.status_code > 499:
-                print("Error getting profile: " + str(r.status_code))
-                print(r.text)
-        success = True
-        print("got", url)
-        try:
-            j = r.json()
-        except Exception as e:
-            print("Error parsing JSON")
-            print(e)
-            print(r.text)
-            time.sleep(sleep_time)
-            return 0
-    if success:
-        print("parsed", url)
-        time.sleep(sleep_time)
-    return j
+    # If data is missing then ignore errors and continue to next connection.
+    # Rate limits and internal errors have already been retried by the session.
+    try:
+        r = SESSION.get(lix_url)
+    except Exception as e:
+        log("Error getting profile data for " + url + ": " + str(e))
+        return 0
+    # check status
+    status = classify_response(r)
+    if status == "not_found":
+        log("Profile not found: " + url)
+        return 0
+    # if a client error then stop
+    if status == "fail":
+        log("Error getting profile " + url + ": " + str(r.status_code) + " " + r.text)
+        raise Exception("Client error " + str(r.status_code))
+    # skip bodies that aren't JSON, e.g. a proxy error page or a truncated response, so the profile is
+    # retried on the next run rather than stored and marked as collected
+    try:
+        r.json()
+    except ValueError:
+        log("Invalid response for " + url)
+        return 0
+    # the body is already JSON, so return it as-is to be stored rather than decoding and re-encoding it
+    return r.text
 
 
 # for each profile link, get the data from the Lix API and save
 def collect_data(conn, orgs):
-    for org in orgs:
-        profile_url = org[2]
-        data = get_profile(profile_url)
-        if data == 0:
-            continue
-        json_data = json.dumps(data)
-        # This assumes we are only running one thread and therefore don't need to lock the database
-        conn.execute(
-            "insert into orgs_enriched (org_id, data, collected_at) values (?, ?, ?)",
-            (org[0], json_data, datetime.datetime.now()),
-        )
-        conn.execute(
-            "update orgs set last_collected_at = ? where id = ?",
-            (datetime.datetime.now(), org[0]),
-        )
-        conn.commit()
-        print("collected", profile_url)
+    # transactions are started and committed explicitly in save_orgs
+    conn.isolation_level = None
+    rows = []
+    # Profiles are fetched on worker threads; the session's connection pool is shared between them
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(batch):
+        return {executor.submit(get_profile, org[2]): org for org in batch}
+
+    try:
+        # submit one batch at a time rather than queueing a future for every org up front,
+        # keeping the next batch queued while the current one is drained and saved so the
+        # workers carry on fetching during the database write
+        futures = submit(orgs[:batch_size])
+        for start in range(batch_size, len(orgs) + batch_size, batch_size):
+            next_futures = submit(orgs[start : start + batch_size])
+            for future in as_completed(futures):
+                org = futures[future]
+                data = future.result()
+                if data == 0:
+                    continue
+                rows.append((org[0], data))
+                log("collected " + org[2])
+            save_orgs(conn, rows)
+            rows = []
+            futures = next_futures
+    finally:
+        # stop fetching if collection is interrupted, e.g. by a client error
+        executor.shutdown(cancel_futures=True)
+        # and keep whatever was collected before it stopped
+        save_orgs(conn, rows)
+
+
+# save a batch of org data and mark the profile links as collected in one transaction
+def save_orgs(conn, rows):
+    if not rows:
+        return
+    # the whole batch is saved at once, so one timestamp covers every org in it
+    collected_at = int(time.time())
+    # Only the main thread writes, so the database doesn't need to be locked
+    conn.execute("begin")
+    try:
+        cur = conn.cursor()
+        # generators let sqlite3 step through the rows without building more lists
+        cur.executemany(INSERT_SQL, ((org_id, data, collected_at) for org_id, data in rows))
+        cur.executemany(UPDATE_SQL, ((collected_at, org_id) for org_id, _ in rows))
+    except BaseException:
+        conn.execute("rollback")
+        raise
+    conn.execute("commit")
+    log("saved " + str(len(rows)) + " orgs")
 
 
 if __name__ == "__main__":
     if args.command == "migrate":
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         migrate(conn)
         conn.close()
         print(
@@ -174,10 +272,16 @@ if __name__ == "__main__":
         sys.exit(0)
 
     if args.command == "import":
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         print("Importing data from", args.import_path, "...")
-        orgs = pd.read_csv(args.import_path)
-        orgs.to_sql("orgs", conn, if_exists="append", index=False)
+        # stream the CSV straight into the table in a single transaction
+        # utf-8-sig drops the byte order mark Excel adds, which would otherwise end up in the first header
+        with open(args.import_path, newline="", encoding="utf-8-sig") as f, conn:
+            reader = csv.DictReader(f)
+            conn.executemany(
+                "insert into orgs (name, link) values (?, ?)",
+                ((row["name"], row["link"]) for row in reader),
+            )
         conn.close()
         print("Data imported.")
         sys.exit(0)
@@ -188,7 +292,7 @@ if __name__ == "__main__":
 
     # open the database if it doesn't exist then error and say to migrate first
     try:
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
     except sqlite3.OperationalError:
         print("Database does not exist. Run `python [PATH]/org.py migrate` first.")
         sys.exit(1)
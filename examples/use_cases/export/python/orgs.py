@@ -5,7 +5,6 @@ This script exports data from the orgs_enriched table to a CSV file, picking onl
 import csv
 import sqlite3
 import argparse
-import json
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--output", help="The output file", default="output/orgs.csv")
@@ -17,27 +16,26 @@ args = parser.parse_args()
 conn = sqlite3.connect(args.db_path)
 c = conn.cursor()
 
-c.execute("select data from orgs_enriched")
-rows = c.fetchall()
+# count the rows up front, the rows themselves are streamed below
+row_count = c.execute("select count(*) from orgs_enriched").fetchone()[0]
 
-# parse json and extract name, link, and location
-rows = [
-    (
-        json.loads(row[0])["profile"]["name"],
-        json.loads(row[0])["profile"]["linkedinUrl"],
-        json.loads(row[0])["profile"]["industry"],
-        json.loads(row[0])["profile"]["description"],
-        json.loads(row[0])["profile"]["employeeCount"],
-    )
-    for row in rows
-]
+# let SQLite extract name, link, industry, description, and employee count,
+# streaming the rows straight from the cursor into the CSV
+c.execute(
+    """select json_extract(data, '$.profile.name'),
+              json_extract(data, '$.profile.linkedinUrl'),
+              json_extract(data, '$.profile.industry'),
+              json_extract(data, '$.profile.description'),
+              json_extract(data, '$.profile.employeeCount')
+       from orgs_enriched"""
+)
 
-with open(args.output, "w") as f:
-    print("Exporting {} rows to".format(len(rows)), args.output, "...")
+with open(args.output, "w", newline="") as f:
+    print("Exporting {} rows to".format(row_count), args.output, "...")
     writer = csv.writer(f)
     writer.writerow(
         ["name", "linkedin_url", "industry", "description", "employee_count"]
     )
-    writer.writerows(rows)
+    writer.writerows(c)
 
 print("Exported to", args.output)
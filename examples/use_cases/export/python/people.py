@@ -4,7 +4,6 @@ This script exports data from the people_enriched table to a CSV file, picking o
 import csv
 import sqlite3
 import argparse
-import json
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--output", help="The output file", default="output/people.csv")
@@ -14,23 +13,20 @@ args = parser.parse_args()
 conn = sqlite3.connect(args.db_path)
 c = conn.cursor()
 
-c.execute("select data from people_enriched")
-rows = c.fetchall()
+# count the rows up front, the rows themselves are streamed below
+row_count = c.execute("select count(*) from people_enriched").fetchone()[0]
 
-# parse json and extract name, link, and location
-rows = [
-    (
-        json.loads(row[0])["name"],
-        json.loads(row[0])["link"],
-        json.loads(row[0])["location"],
-    )
-    for row in rows
-]
+# let SQLite extract name, link, and location from the json, streaming the rows straight from the
+# cursor into the CSV
+c.execute(
+    """select json_extract(data, '$.name'), json_extract(data, '$.link'), json_extract(data, '$.location')
+    from people_enriched"""
+)
 
-with open(args.output, "w") as f:
-    print("Exporting {} rows to".format(len(rows)), args.output, "...")
+with open(args.output, "w", newline="") as f:
+    print("Exporting {} rows to".format(row_count), args.output, "...")
     writer = csv.writer(f)
     writer.writerow(["name", "link", "location"])
-    writer.writerows(rows)
+    writer.writerows(c)
 
 print("Exported to", args.output)